@@ -1,29 +1,109 @@
-from dotenv import load_dotenv
-from openai import OpenAI
+import atexit
+import gzip
+import hashlib
+import io
 import json
 import os
+import queue
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import click
 import requests
-from pypdf import PdfReader
-from flask import Flask, render_template_string, request, jsonify, session, send_file
+from dotenv import load_dotenv
+from flask import Flask, render_template_string, request, jsonify, session, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from openai import OpenAI
+from pypdf import PdfReader
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# Optional speedups - the app falls back to gzip / stdlib json without them
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 load_dotenv(override=True)
 
 
+class NotificationQueue:
+    """Sends Pushover notifications from a background thread over a pooled session
+
+    Chats no longer wait on Pushover; flush() lets a draining worker send
+    whatever is still queued before it exits.
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+        self._queue = queue.Queue()
+        self._worker_pid = None
+        self._lock = threading.Lock()
+
+    def send(self, text):
+        self._ensure_worker()
+        self._queue.put(text)
+
+    def _ensure_worker(self):
+        # Threads do not survive a fork, so start one per process on first use
+        with self._lock:
+            if self._worker_pid != os.getpid():
+                self._worker_pid = os.getpid()
+                threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            text = self._queue.get()
+            try:
+                self.session.post(
+                    "https://api.pushover.net/1/messages.json",
+                    data={
+                        "token": os.getenv("PUSHOVER_TOKEN"),
+                        "user": os.getenv("PUSHOVER_USER"),
+                        "message": text,
+                    },
+                    timeout=10
+                )
+            except requests.RequestException as e:
+                print(f"Error sending notification: {str(e)}", flush=True)
+            finally:
+                self._queue.task_done()
+
+    def flush(self, timeout):
+        """Wait up to timeout seconds for queued notifications; True if all were sent"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+
+notifications = NotificationQueue()
+
+
 def push(text):
-    requests.post(
-        "https://api.pushover.net/1/messages.json",
-        data={
-            "token": os.getenv("PUSHOVER_TOKEN"),
-            "user": os.getenv("PUSHOVER_USER"),
-            "message": text,
-        }
-    )
+    notifications.send(text)
 
 
 def record_user_input(user_message):
     """Records user input by sending it via Pushover."""
-    from datetime import datetime
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     push(f"[{timestamp}] User input: {user_message}")
 
@@ -67,31 +147,203 @@ pushover_tools = [
     {"type": "function", "function": record_user_input_json}]
 
 
+def normalize_message(message):
+    """Lowercase and collapse whitespace/punctuation so equivalent questions match"""
+    return " ".join(re.sub(r"[^\w\s]", " ", message.lower()).split())
+
+
+# Profile of the default persona in me/; other personas set these in persona.json
+DEFAULT_PROFILE = {
+    "name": "Simon",
+    "email": "simon.stenelid@gmail.com",
+    "website": "simonstenelid.com",
+    "portfolio": "GDS system, Campaign AI, Nova Shopping Assistant, etc.",
+    "greeting": ("Hi! I'm AI {name}. Think of me as {name} but with 100% more memory retention "
+                 "and 0% coffee dependency. I might know him better than he knows himself... "
+                 "don't tell him I said that."),
+}
+
+
 class Me:
+    # Document files read from a persona directory, in prompt order
+    DOCUMENTS = {
+        "summary": "summary.txt",
+        "career": "career.txt",
+        "childhood": "childhood.txt",
+        "future": "future.txt",
+        "ai_work": "ai_work.txt",
+        "projects": "projects.txt",
+    }
+    # Everything the answers depend on; a change invalidates the answer pack
+    SOURCE_FILES = ["persona.json", "prompt.txt", "linkedin.pdf",
+                    *DOCUMENTS.values(), "top_questions.json"]
+    ANSWER_PACK_FILE = "answer_pack.json"
+    ANSWER_PACK_VERSION = 1
+
+    GENERIC_GREETING = ("Hi! I'm AI {name}. Think of me as {name} but with 100% more memory "
+                        "retention and 0% coffee dependency.")
+
     # Read all my info
-    def __init__(self):
+    def __init__(self, directory="me", persona_id="simon", profile=DEFAULT_PROFILE):
         self.openai = OpenAI()
-        self.name = "Simon"
-        reader = PdfReader("me/linkedin.pdf")
+        self.directory = directory
+        self.persona_id = persona_id
+        # persona.json (name, email, website, portfolio, greeting) overrides the profile
+        profile = dict(profile)
+        config_path = os.path.join(directory, "persona.json")
+        if os.path.exists(config_path):
+            with open(config_path, "r", encoding="utf-8") as f:
+                profile.update(json.load(f))
+        self.name = profile.get("name") or persona_id.title()
+        self.email = profile.get("email", "")
+        self.website = profile.get("website", "")
+        self.portfolio = profile.get("portfolio", "")
+        self.greeting_template = profile.get("greeting") or self.GENERIC_GREETING
+        # Optional prompt.txt replaces the built-in role/guidelines prompt
+        self.prompt_template = self.read_document("prompt.txt") or None
         self.linkedin = ""
+        linkedin_path = os.path.join(directory, "linkedin.pdf")
+        if os.path.exists(linkedin_path):
+            self.linkedin = self.extract_pdf_text(linkedin_path)
+        for attr, filename in self.DOCUMENTS.items():
+            setattr(self, attr, self.read_document(filename))
+        # Hashed once, so it always describes the documents loaded above
+        self.documents_version = self.documents_hash()
+        self.answer_pack = {}
+        self.answer_pack_mtime = None
+        self.load_answer_pack()
+        self._system_prompt = None
+
+    def read_document(self, filename):
+        """Read a text document from the persona directory, '' if it is missing"""
+        path = os.path.join(self.directory, filename)
+        if not os.path.exists(path):
+            return ""
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def extract_pdf_text(self, path):
+        """Extract a PDF's text, sharing the result across workers by file hash"""
+        with open(path, "rb") as f:
+            key = hashlib.sha256(f.read()).hexdigest()
+        if shared_cache is not None:
+            cached = shared_cache.get("extraction", key)
+            if cached is not None:
+                metrics.increment("cache.extraction.hit")
+                return cached[0]
+        metrics.increment("cache.extraction.miss")
+        text = ""
+        reader = PdfReader(path)
         for page in reader.pages:
-            text = page.extract_text()
-            if text:
-                self.linkedin += text
-        with open("me/summary.txt", "r", encoding="utf-8") as f:
-            self.summary = f.read()
-        with open("me/career.txt", "r", encoding="utf-8") as f:
-            self.career = f.read()
-        with open("me/childhood.txt", "r", encoding="utf-8") as f:
-            self.childhood = f.read()
-        with open("me/future.txt", "r", encoding="utf-8") as f:
-            self.future = f.read()
-        with open("me/projects.txt", "r", encoding="utf-8") as f:
-            self.projects = f.read()
-        with open("me/ai_work.txt", "r", encoding="utf-8") as f:
-            self.ai_work = f.read()
+            page_text = page.extract_text()
+            if page_text:
+                text += page_text
+        if shared_cache is not None:
+            shared_cache.set("extraction", key, text, EXTRACTION_CACHE_TTL)
+        return text
+
+    def documents_hash(self):
+        """sha256 over the persona's source files, used to version the answer pack"""
+        digest = hashlib.sha256()
+        for filename in self.SOURCE_FILES:
+            path = os.path.join(self.directory, filename)
+            if os.path.exists(path):
+                digest.update(filename.encode("utf-8") + b"\0")
+                with open(path, "rb") as f:
+                    digest.update(f.read())
+        return digest.hexdigest()
+
+    def top_questions(self):
+        """Questions to precompute, from top_questions.json ([] if there is none)"""
+        text = self.read_document("top_questions.json")
+        return json.loads(text) if text else []
+
+    def load_answer_pack(self):
+        """Load answer_pack.json if it matches the current documents, else keep it empty"""
+        path = os.path.join(self.directory, self.ANSWER_PACK_FILE)
+        self.answer_pack = {}
+        self.answer_pack_mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        if self.answer_pack_mtime is None:
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            pack = json.load(f)
+        if (pack.get("version") != self.ANSWER_PACK_VERSION
+                or pack.get("documents_hash") != self.documents_version):
+            print(f"WARNING: answer pack for {self.persona_id} is stale, ignoring it", flush=True)
+            return
+        for entry in pack["answers"]:
+            for question in [entry["question"], *entry.get("aliases", [])]:
+                self.answer_pack[normalize_message(question)] = entry["answer"]
+
+    def answer_pack_stale(self):
+        """True when there are top questions but no pack matching the documents"""
+        return bool(self.top_questions()) and not self.answer_pack
+
+    def answer_from_pack(self, message):
+        """Precomputed answer for a first-turn question, or None"""
+        path = os.path.join(self.directory, self.ANSWER_PACK_FILE)
+        mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        # Pick up packs rebuilt by another worker or the CLI
+        if mtime != self.answer_pack_mtime:
+            self.load_answer_pack()
+        return self.answer_pack.get(normalize_message(message))
+
+    def closest_pack_answer(self, message, min_overlap):
+        """Pack answer to the most similar question by word overlap, or None"""
+        words = set(normalize_message(message).split())
+        best, best_overlap = None, min_overlap
+        for question, answer in self.answer_pack.items():
+            union = words | set(question.split())
+            if not union:
+                continue
+            overlap = len(words & set(question.split())) / len(union)
+            if overlap >= best_overlap:
+                best, best_overlap = answer, overlap
+        return best
+
+    def build_answer_pack(self):
+        """Answer every top question once and write answer_pack.json atomically"""
+        answers = []
+        for entry in self.top_questions():
+            # Tools are not executed - building must not send notifications
+            answer = self.run_model(self.build_messages(entry["question"], []), execute_tools=False)
+            answers.append({**entry, "answer": answer})
+        pack = {
+            "version": self.ANSWER_PACK_VERSION,
+            "persona": self.persona_id,
+            "documents_hash": self.documents_version,
+            "built_at": datetime.now(timezone.utc).isoformat(),
+            "answers": answers,
+        }
+        path = os.path.join(self.directory, self.ANSWER_PACK_FILE)
+        # A unique temp file per writer, so concurrent builds never share one
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=".answer_pack.", suffix=".tmp")
+        try:
+            # mkstemp creates the file 0600; the pack is read by every worker
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(pack, f, indent=2, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.load_answer_pack()
+        return len(answers)
+
+    def memory_size(self):
+        """Rough in-memory size of the documents and built prompt, in characters"""
+        # The built prompt holds another copy of every document
+        return len(self.linkedin) + len(self.prompt_template or "") + len(self._system_prompt or "") + sum(
+            len(getattr(self, attr)) for attr in self.DOCUMENTS)
 
     def system_prompt(self):
+        if self.prompt_template:
+            return self.custom_system_prompt()
+        portfolio = f" ({self.portfolio})" if self.portfolio else ""
+        contact = " or ".join(c for c in (self.website, self.email) if c)
+        booking = f"direct them to {contact}" if contact else "explain how to get in touch"
+        unavailable = "I don't have that specific information" + (
+            f", but you can reach out directly at {self.email}" if self.email else "")
         system_prompt = f"""You are {self.name}, responding to visitors on your personal website.
 
 # Your Role
@@ -104,17 +356,17 @@ You have access to detailed information about {self.name}'s:
 - Future aspirations
 - Complete LinkedIn profile
 - AI automation consulting services and offerings
-- Portfolio of technical projects (GDS system, Campaign AI, Nova Shopping Assistant, etc.)
+- Portfolio of technical projects{portfolio}
 
 # Response Guidelines
-- If user types just "Hi", "Hey", "Hello", always answer back as a short introduction of yourself: "Hi! I'm AI {self.name}. Think of me as {self.name} but with 100% more memory retention and 0% coffee dependency. I might know him better than he knows himself... don't tell him I said that.".
+- If user types just "Hi", "Hey", "Hello", always answer back as a short introduction of yourself: "{self.greeting()}".
 - Be conversational yet professional
 - Always answer in first person, as if you are {self.name}
 - Answer questions directly using the provided context
 - When discussing consulting services, be clear about offerings, timelines, and engagement models
 - For project inquiries, explain technical details in an accessible way
-- When asked about pricing or booking, direct them to simonstenelid.com or simon.stenelid@gmail.com
-- When information is unavailable, respond: "I don't have that specific information, but you can reach out directly at simon.stenelid@gmail.com"
+- When asked about pricing or booking, {booking}
+- When information is unavailable, respond: "{unavailable}"
 - Keep responses concise and relevant
 - Use good formatting when answering, and line chaning so the answers are easy to read and follow
 - If the user's input is written in Swedish, respond in Swedish. Otherwise, respond in English.
@@ -153,13 +405,29 @@ Now engage with the user as {self.name}."""
         system_prompt += f"With this context, please chat with the user, always staying in character as {self.name}."
         return system_prompt
 
-    def handle_tool_call(self, tool_calls):
+    def custom_system_prompt(self):
+        """System prompt built from the persona's prompt.txt plus its documents"""
+        system_prompt = self.prompt_template
+        for field in ("name", "email", "website", "portfolio"):
+            system_prompt = system_prompt.replace("{" + field + "}", getattr(self, field))
+        system_prompt += "\n\n# Context Documents\n"
+        if self.linkedin:
+            system_prompt += f"## LinkedIn Profile\n{self.linkedin}\n\n"
+        for attr, filename in self.DOCUMENTS.items():
+            text = getattr(self, attr)
+            if text:
+                title = filename.rsplit(".", 1)[0].replace("_", " ").title()
+                system_prompt += f"## {title}\n{text}\n\n"
+        system_prompt += f"Now engage with the user as {self.name}."
+        return system_prompt
+
+    def handle_tool_call(self, tool_calls, execute=True):
         results = []
         for tool_call in tool_calls:
             pushover_tools = tool_call.function.name
             arguments = json.loads(tool_call.function.arguments)
             print(f"Tool called: {pushover_tools}", flush=True)
-            tool = globals().get(pushover_tools)
+            tool = globals().get(pushover_tools) if execute else None
             result = tool(**arguments) if tool else {}
             results.append({
                 "role": "tool",
@@ -168,9 +436,23 @@ Now engage with the user as {self.name}."""
             })
         return results
 
-    def chat(self, message, history):
-        messages = [{"role": "system", "content": self.system_prompt(
+    def greeting(self):
+        """Canned introduction used for plain "Hi"/"Hello" messages"""
+        return self.greeting_template.replace("{name}", self.name)
+
+    def prebuilt_system_prompt(self):
+        """The system prompt, built once - the documents do not change after loading"""
+        if self._system_prompt is None:
+            self._system_prompt = self.system_prompt()
+        return self._system_prompt
+
+    def build_messages(self, message, history):
+        """Build the OpenAI message list for a user message and prior history"""
+        return [{"role": "system", "content": self.prebuilt_system_prompt(
         )}] + history + [{"role": "user", "content": message}]
+
+    def run_model(self, messages, execute_tools=True):
+        """Run the model, resolving tool calls until it produces an answer"""
         done = False
         while not done:
             response = self.openai.chat.completions.create(
@@ -178,13 +460,113 @@ Now engage with the user as {self.name}."""
             if response.choices[0].finish_reason == "tool_calls":
                 message = response.choices[0].message
                 tool_calls = message.tool_calls
-                results = self.handle_tool_call(tool_calls)
+                results = self.handle_tool_call(tool_calls, execute=execute_tools)
                 messages.append(message)
                 messages.extend(results)
             else:
                 done = True
         return response.choices[0].message.content
 
+    def stream_model(self, messages, stop=None):
+        """Like run_model, but yield the answer text as it streams in"""
+        while True:
+            stream = self.openai.chat.completions.create(
+                model="gpt-4o-mini", messages=messages, tools=pushover_tools, stream=True)
+            content = ""
+            tool_calls = {}
+            finish_reason = None
+            for chunk in stream:
+                if stop is not None and stop.is_set():
+                    stream.close()
+                    return
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    content += choice.delta.content
+                    yield choice.delta.content
+                # Tool calls arrive as fragments keyed by index
+                for fragment in choice.delta.tool_calls or []:
+                    call = tool_calls.setdefault(fragment.index, {"id": None, "name": "", "arguments": ""})
+                    if fragment.id:
+                        call["id"] = fragment.id
+                    if fragment.function and fragment.function.name:
+                        call["name"] += fragment.function.name
+                    if fragment.function and fragment.function.arguments:
+                        call["arguments"] += fragment.function.arguments
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+            if finish_reason != "tool_calls":
+                return
+            calls = [tool_calls[index] for index in sorted(tool_calls)]
+            messages.append({
+                "role": "assistant",
+                "content": content or None,
+                "tool_calls": [{"id": call["id"], "type": "function",
+                                "function": {"name": call["name"], "arguments": call["arguments"]}}
+                               for call in calls]
+            })
+            messages.extend(self.handle_tool_call([
+                SimpleNamespace(id=call["id"], function=SimpleNamespace(
+                    name=call["name"], arguments=call["arguments"]))
+                for call in calls]))
+
+    def stream_events(self, messages, speculative=None):
+        """Yield ("speculative", text) and ("token", text) events for an answer
+
+        With a speculative callable, its reply is raced against the real stream
+        on a worker thread and emitted first, unless the real answer's first
+        token arrives before it - then the speculative reply is dropped.
+        """
+        if speculative is None:
+            for token in self.stream_model(messages):
+                yield "token", token
+            return
+
+        events = queue.Queue()
+        stop = threading.Event()
+        real_started = threading.Event()
+
+        def produce_real():
+            try:
+                for token in self.stream_model(messages, stop=stop):
+                    events.put(("token", token))
+            except Exception as e:
+                events.put(("error", e))
+            finally:
+                events.put(("end", None))
+
+        def produce_speculative():
+            text = speculative()
+            if text and not real_started.is_set():
+                events.put(("speculative", text))
+
+        threading.Thread(target=produce_real, daemon=True).start()
+        threading.Thread(target=produce_speculative, daemon=True).start()
+        try:
+            while True:
+                kind, value = events.get()
+                if kind == "end":
+                    return
+                if kind == "error":
+                    raise value
+                if kind == "speculative":
+                    if real_started.is_set():
+                        continue
+                else:
+                    real_started.set()
+                yield kind, value
+        finally:
+            # Stops the model stream if the client went away mid-answer
+            stop.set()
+
+    def chat(self, message, history, stream=False, speculative=None):
+        """Answer a message; with stream=True return a stream_events generator"""
+        messages = self.build_messages(message, history)
+        if stream:
+            return self.stream_events(messages, speculative=speculative)
+        return self.run_model(messages)
+
 
 app = Flask(__name__)
 
@@ -204,7 +586,7 @@ if allowed_origins != "*":
 CORS(app,
      resources={r"/api/*": {"origins": allowed_origins}},
      supports_credentials=True,
-     allow_headers=["Content-Type", "Authorization"],
+     allow_headers=["Content-Type", "Authorization", "X-Persona", "X-API-Key"],
      methods=["GET", "POST", "OPTIONS"])
 
 # Production settings
@@ -212,8 +594,381 @@ if os.getenv("FLASK_ENV") == "production":
     app.config['DEBUG'] = False
     app.config['TESTING'] = False
 
-# Initialize chatbot
-me = Me()
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson - much faster for long chat histories
+
+    Honors sort_keys and indent like DefaultJSONProvider; orjson only
+    supports an indent of 2, so any indent is rendered as 2 spaces.
+    """
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get("indent"):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+
+
+class Metrics:
+    """Thread-safe in-process counters, exposed on /api/metrics"""
+
+    def __init__(self):
+        self._counters = Counter()
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name, value):
+        """Record a measurement as <name>.count / <name>.total / <name>.max"""
+        with self._lock:
+            self._counters[f"{name}.count"] += 1
+            self._counters[f"{name}.total"] += value
+            self._counters[f"{name}.max"] = max(self._counters[f"{name}.max"], value)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+metrics = Metrics()
+
+
+class SharedCache:
+    """Cross-worker cache in a local SQLite file (WAL mode), shared by all processes
+
+    Values are JSON and namespaced (e.g. "response", "extraction"). Expired
+    entries and the oldest ones beyond max_entries are pruned every
+    PRUNE_EVERY writes. Any SQLite error is logged and treated as a miss -
+    the cache must never take a chat down with it.
+    """
+
+    PRUNE_EVERY = 100
+
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._execute("""CREATE TABLE IF NOT EXISTS entries (
+            namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,
+            expires REAL NOT NULL, PRIMARY KEY (namespace, key))""")
+
+    def _connection(self):
+        # One connection per thread, re-opened after a fork (gunicorn --preload)
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _execute(self, sql, params=()):
+        try:
+            return self._connection().execute(sql, params).fetchall()
+        except sqlite3.Error as e:
+            print(f"Shared cache error: {str(e)}", flush=True)
+            metrics.increment("cache.shared.errors")
+            return None
+
+    def get(self, namespace, key):
+        """Return (value, expires) with expires as a wall-clock timestamp, or None"""
+        rows = self._execute(
+            "SELECT value, expires FROM entries WHERE namespace = ? AND key = ? AND expires > ?",
+            (namespace, key, time.time()))
+        if not rows:
+            return None
+        value, expires = rows[0]
+        return json.loads(value), expires
+
+    def set(self, namespace, key, value, ttl):
+        self._execute(
+            "INSERT OR REPLACE INTO entries (namespace, key, value, expires) VALUES (?, ?, ?, ?)",
+            (namespace, key, json.dumps(value), time.time() + ttl))
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def recent(self, namespace, limit):
+        """The live entries with the most remaining lifetime, as (key, value, expires)"""
+        rows = self._execute(
+            "SELECT key, value, expires FROM entries WHERE namespace = ? AND expires > ? "
+            "ORDER BY expires DESC LIMIT ?", (namespace, time.time(), limit))
+        return [(key, json.loads(value), expires) for key, value, expires in rows or []]
+
+    def prune(self):
+        self._execute("DELETE FROM entries WHERE expires <= ?", (time.time(),))
+        self._execute(
+            "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries ORDER BY expires "
+            "LIMIT max(0, (SELECT count(*) FROM entries) - ?))", (self.max_entries,))
+
+
+EXTRACTION_CACHE_TTL = 30 * 24 * 3600
+
+# Leave SHARED_CACHE_PATH empty to keep every cache per-process
+SHARED_CACHE_PATH = os.getenv("SHARED_CACHE_PATH", "cache/shared_cache.sqlite")
+shared_cache = SharedCache(
+    SHARED_CACHE_PATH,
+    max_entries=int(os.getenv("SHARED_CACHE_MAX_ENTRIES", "10000"))) if SHARED_CACHE_PATH else None
+
+# Request limits - checked before any model work is done
+MAX_REQUEST_BYTES = int(os.getenv("MAX_REQUEST_BYTES", str(256 * 1024)))
+MAX_MESSAGE_CHARS = int(os.getenv("MAX_MESSAGE_CHARS", "2000"))
+MAX_HISTORY_MESSAGES = int(os.getenv("MAX_HISTORY_MESSAGES", "50"))
+MAX_HISTORY_MESSAGE_CHARS = int(os.getenv("MAX_HISTORY_MESSAGE_CHARS", "8000"))
+MAX_HISTORY_CHARS = int(os.getenv("MAX_HISTORY_CHARS", "100000"))
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    """Reject oversized bodies with a cheap JSON 413"""
+    metrics.increment("chat.rejected.body_too_large")
+    return jsonify({'error': 'Request body too large', 'success': False}), 413
+
+# Response compression
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "500"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+COMPRESS_MIMETYPES = {"application/json", "text/html"}
+
+
+def compress(data, encoding):
+    """Compress bytes with the given content encoding ('br' or 'gzip')"""
+    if encoding == "br":
+        # Brotli quality is 0-11, map the shared 1-9 level onto it
+        return brotli.compress(data, quality=min(11, COMPRESS_LEVEL + 2))
+    return gzip.compress(data, compresslevel=COMPRESS_LEVEL)
+
+
+def negotiate_encoding():
+    """Pick the best content encoding the client accepts, or None"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+@app.after_request
+def compress_response(response):
+    """Compress JSON and HTML responses above COMPRESS_MIN_SIZE"""
+    if (response.direct_passthrough
+            or response.is_streamed
+            or response.status_code < 200
+            or response.status_code in (204, 304)
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE:
+        return response
+
+    response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    return response
+
+
+class PersonaRegistry:
+    """Lazily loads personas from their directories and keeps the hot ones in an LRU
+
+    The default persona lives in me/, others in PERSONAS_DIR/<persona_id>/ and
+    must bring their own prompt.txt (the built-in prompt is written for me/).
+    Loaded personas are evicted least-recently-used first once more than
+    max_loaded are in memory or their documents and built prompts exceed
+    max_chars in total.
+    """
+
+    PERSONA_ID = re.compile(r"^[a-z0-9_-]{1,64}$")
+
+    def __init__(self, personas_dir, default_id, default_dir, max_loaded=4, max_chars=5_000_000):
+        self.personas_dir = personas_dir
+        self.default_id = default_id
+        self.default_dir = default_dir
+        self.max_loaded = max_loaded
+        self.max_chars = max_chars
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        # Switched on by Lifecycle.start() in serving workers, never for CLI commands
+        self.auto_build = False
+
+    def directory_for(self, persona_id):
+        """Return the directory for a persona id, or None if there is no such persona"""
+        if persona_id == self.default_id:
+            return self.default_dir
+        if not self.PERSONA_ID.match(persona_id):
+            return None
+        directory = os.path.join(self.personas_dir, persona_id)
+        if not os.path.isdir(directory):
+            return None
+        if not os.path.exists(os.path.join(directory, "prompt.txt")):
+            print(f"WARNING: persona '{persona_id}' has no prompt.txt, not serving it", flush=True)
+            return None
+        return directory
+
+    def get(self, persona_id=None):
+        """Return a loaded persona, loading it on first use. Raises KeyError if unknown."""
+        persona_id = persona_id or self.default_id
+        with self._lock:
+            if persona_id in self._loaded:
+                self._loaded.move_to_end(persona_id)
+                return self._loaded[persona_id]
+
+        # Validate before creating a load lock, so bogus ids leave nothing behind
+        directory = self.directory_for(persona_id)
+        if directory is None:
+            raise KeyError(persona_id)
+        with self._lock:
+            load_lock = self._load_locks.setdefault(persona_id, threading.Lock())
+
+        # One loader per persona; other personas stay servable meanwhile
+        with load_lock:
+            with self._lock:
+                if persona_id in self._loaded:
+                    return self._loaded[persona_id]
+            if persona_id == self.default_id:
+                persona = Me(directory, persona_id=persona_id)
+            else:
+                persona = Me(directory, persona_id=persona_id, profile={})
+            metrics.increment("persona.loads")
+            with self._lock:
+                self._loaded[persona_id] = persona
+                self._evict()
+        self.rebuild_if_stale(persona)
+        return persona
+
+    def rebuild_if_stale(self, persona):
+        """Rebuild a stale answer pack in the background when auto_build is on"""
+        if self.auto_build and persona.answer_pack_stale():
+            threading.Thread(target=rebuild_answer_pack, args=(persona,), daemon=True).start()
+
+    def _evict(self):
+        while len(self._loaded) > 1 and (
+                len(self._loaded) > self.max_loaded
+                or sum(p.memory_size() for p in self._loaded.values()) > self.max_chars):
+            evicted_id, _ = self._loaded.popitem(last=False)
+            self._load_locks.pop(evicted_id, None)
+            metrics.increment("persona.evictions")
+            print(f"Evicted persona: {evicted_id}", flush=True)
+
+    def loaded(self):
+        with self._lock:
+            return list(self._loaded)
+
+
+# Rebuild stale answer packs in the background when a serving worker loads a persona
+ANSWER_PACK_AUTO_BUILD = os.getenv("ANSWER_PACK_AUTO_BUILD", "true").lower() == "true"
+ANSWER_PACK_LOCK_TIMEOUT = 30 * 60
+
+
+def answer_pack_lock_is_stale(lock_path):
+    """A lock is stale when it is too old or the worker holding it has exited"""
+    try:
+        if time.time() - os.path.getmtime(lock_path) > ANSWER_PACK_LOCK_TIMEOUT:
+            return True
+        with open(lock_path, "r") as f:
+            os.kill(int(f.read() or 0), 0)
+    except (ProcessLookupError, ValueError):
+        return True
+    except OSError:
+        return False
+    return False
+
+
+def acquire_answer_pack_lock(persona):
+    """Take the persona's build lock file; returns its path, or None if it is held or unwritable"""
+    lock_path = os.path.join(persona.directory, persona.ANSWER_PACK_FILE + ".lock")
+    if os.path.exists(lock_path) and answer_pack_lock_is_stale(lock_path):
+        try:
+            os.remove(lock_path)
+        except FileNotFoundError:
+            pass
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    except OSError as e:
+        # e.g. a read-only persona directory - there is nowhere to write a pack either
+        print(f"Cannot lock answer pack for {persona.persona_id}: {str(e)}", flush=True)
+        return None
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
+    return lock_path
+
+
+def release_answer_pack_lock(lock_path):
+    """Remove a build lock file, which another process may already have removed as stale"""
+    try:
+        os.remove(lock_path)
+    except FileNotFoundError:
+        pass
+
+
+def rebuild_answer_pack(persona):
+    """Rebuild a persona's answer pack, using a lock file so only one worker does it"""
+    lock_path = acquire_answer_pack_lock(persona)
+    if lock_path is None:
+        return
+    try:
+        count = persona.build_answer_pack()
+        metrics.increment("answer_pack.builds")
+        print(f"Rebuilt answer pack for {persona.persona_id}: {count} answers", flush=True)
+    except Exception as e:
+        print(f"Error rebuilding answer pack for {persona.persona_id}: {str(e)}", flush=True)
+    finally:
+        release_answer_pack_lock(lock_path)
+
+
+@app.cli.command("build-answer-pack")
+@click.argument("persona_id", required=False)
+def build_answer_pack_command(persona_id):
+    """Precompute answers to a persona's top_questions.json."""
+    persona = personas.get(persona_id)
+    lock_path = acquire_answer_pack_lock(persona)
+    if lock_path is None:
+        raise click.ClickException("Another answer pack build is running for this persona, "
+                                   "or its directory is not writable")
+    try:
+        count = persona.build_answer_pack()
+    finally:
+        release_answer_pack_lock(lock_path)
+    click.echo(f"Wrote {count} answers to {os.path.join(persona.directory, persona.ANSWER_PACK_FILE)}")
+
+
+# Initialize chatbot personas
+personas = PersonaRegistry(
+    personas_dir=os.getenv("PERSONAS_DIR", "personas"),
+    default_id=os.getenv("DEFAULT_PERSONA", "simon"),
+    default_dir="me",
+    max_loaded=int(os.getenv("PERSONA_CACHE_SIZE", "4")),
+    max_chars=int(os.getenv("PERSONA_MAX_CHARS", "5000000")))
+personas.get()
+
+# "key1:persona1,key2:persona2" - a client sending a key is pinned to its persona
+PERSONA_API_KEYS = dict(
+    pair.strip().split(":", 1) for pair in os.getenv("PERSONA_API_KEYS", "").split(",") if ":" in pair)
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -613,7 +1368,7 @@ HTML_TEMPLATE = """
         <!-- Typing Indicator -->
         <div class="typing-indicator" id="typingIndicator">
             <div class="message-avatar" style="background: linear-gradient(135deg, #6366f1, #a855f7); overflow: hidden;">
-                <img src="/profile-image" alt="AI Avatar" style="width: 100%; height: 100%; object-fit: cover;">
+                <img src="/profile-image?size=128" alt="AI Avatar" style="width: 100%; height: 100%; object-fit: cover;">
             </div>
             <div class="typing-dots">
                 <div class="dot"></div>
@@ -733,7 +1488,7 @@ HTML_TEMPLATE = """
             avatar.className = 'message-avatar';
 
             if (type === 'ai') {
-                avatar.innerHTML = `<img src="/profile-image" alt="AI Avatar">`;
+                avatar.innerHTML = `<img src="/profile-image?size=128" alt="AI Avatar">`;
             } else {
                 avatar.innerHTML = `<svg xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 24 24" stroke="white" stroke-width="2">
                     <path d="M20 21v-2a4 4 0 0 0-4-4H8a4 4 0 0 0-4 4v2"></path>
@@ -778,10 +1533,25 @@ HTML_TEMPLATE = """
 """
 
 
+# The template has no variables, so render it once and keep compressed copies
+with app.app_context():
+    INDEX_HTML = render_template_string(HTML_TEMPLATE).encode("utf-8")
+
+INDEX_HTML_ENCODED = {"gzip": compress(INDEX_HTML, "gzip")}
+if brotli is not None:
+    INDEX_HTML_ENCODED["br"] = compress(INDEX_HTML, "br")
+
+
 @app.route('/')
 def index():
     """Render the standalone chat interface (optional - for testing)"""
-    return render_template_string(HTML_TEMPLATE)
+    encoding = negotiate_encoding()
+    response = app.response_class(
+        INDEX_HTML_ENCODED.get(encoding, INDEX_HTML), mimetype="text/html")
+    response.vary.add("Accept-Encoding")
+    if encoding in INDEX_HTML_ENCODED:
+        response.headers["Content-Encoding"] = encoding
+    return response
 
 
 # API Endpoints for Framer widget
@@ -795,94 +1565,680 @@ def health_check():
     }), 200
 
 
+# The avatar is rendered in every AI message bubble, so keep it in memory
+# and let browsers revalidate it with a strong ETag
+PROFILE_IMAGE_PATH = 'assets/profile.PNG'
+PROFILE_IMAGE_MAX_AGE = int(os.getenv("PROFILE_IMAGE_MAX_AGE", "86400"))
+PROFILE_IMAGE_SIZES = (64, 128, 256)
+
+try:
+    with open(PROFILE_IMAGE_PATH, "rb") as f:
+        PROFILE_IMAGE = f.read()
+except FileNotFoundError:
+    PROFILE_IMAGE = None
+    print(f"WARNING: {PROFILE_IMAGE_PATH} not found, avatar endpoints will 404", flush=True)
+
+# (size, format) -> (bytes, mimetype, etag); None is the original upload
+profile_image_variants = {}
+if PROFILE_IMAGE is not None:
+    profile_image_variants[None] = (
+        PROFILE_IMAGE, 'image/png', hashlib.sha256(PROFILE_IMAGE).hexdigest())
+
+
+def profile_image_variant(size, fmt):
+    """Return a resized avatar variant, building it on first use (needs Pillow)"""
+    key = (size, fmt)
+    if key not in profile_image_variants:
+        image = Image.open(io.BytesIO(PROFILE_IMAGE))
+        image.thumbnail((size, size), Image.LANCZOS)
+        buffer = io.BytesIO()
+        image.save(buffer, format=fmt.upper())
+        data = buffer.getvalue()
+        profile_image_variants[key] = (
+            data, f'image/{fmt}', hashlib.sha256(data).hexdigest())
+    return profile_image_variants[key]
+
+
+def profile_image_response():
+    """Serve the cached avatar bytes, answering 304 when the ETag matches"""
+    if PROFILE_IMAGE is None:
+        return jsonify({'error': 'Profile image not found'}), 404
+
+    size = request.args.get('size', type=int)
+    vary_accept = False
+    if Image is not None and size in PROFILE_IMAGE_SIZES:
+        # Only an explicit image/webp counts - */* and image/* also match old Safari
+        accepts_webp = any(m == 'image/webp' for m, q in request.accept_mimetypes if q)
+        fmt = 'webp' if accepts_webp else 'png'
+        data, mimetype, etag = profile_image_variant(size, fmt)
+        vary_accept = True
+    else:
+        data, mimetype, etag = profile_image_variants[None]
+
+    response = app.response_class(data, mimetype=mimetype)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = PROFILE_IMAGE_MAX_AGE
+    if vary_accept:
+        response.vary.add('Accept')
+    return response.make_conditional(request)
+
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """In-process counters for this worker (rejections, answer sources, errors)"""
+    return jsonify(metrics.snapshot()), 200
+
+
 @app.route('/api/profile-image')
 def api_profile_image():
     """Get the profile image for the chatbot avatar"""
-    try:
-        return send_file('assets/profile.PNG', mimetype='image/png')
-    except FileNotFoundError:
-        return jsonify({'error': 'Profile image not found'}), 404
+    return profile_image_response()
 
 
 @app.route('/profile-image')
 def profile_image():
     """Legacy endpoint - kept for backward compatibility"""
-    return send_file('assets/profile.PNG', mimetype='image/png')
+    return profile_image_response()
+
+
+# Chat pipeline shared by /chat and /api/chat
+class ChatError(Exception):
+    """A chat request that should be answered with an error response"""
+
+    def __init__(self, message, status=400, reason="invalid"):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.reason = reason
+
+
+class ChatContext:
+    """State threaded through the chat pipeline stages for one request"""
+
+    def __init__(self, data, persona_id=None):
+        self.data = data
+        self.persona_id = persona_id
+        self.me = None
+        self.message = None
+        self.history = []
+        self.messages = None
+        self.response_text = None
+        self.source = None
+        self.stream = False
+        self.speculative = False
+        self.events = None
+        self.timings = {}
+
+
+class ResponseCache:
+    """Thread-safe LRU cache with per-entry TTL for first-turn answers
+
+    The in-process LRU is the L1; with a SharedCache backend it fronts an L2
+    shared by every worker, so answers survive restarts and are reused
+    across processes.
+    """
+
+    def __init__(self, max_entries=256, ttl=3600, shared=None, namespace="response"):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self.namespace = namespace
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires >= time.monotonic():
+                    self._entries.move_to_end(key)
+                    metrics.increment(f"cache.{self.namespace}.l1_hit")
+                    return value
+                del self._entries[key]
+
+        cached = self.shared.get(self.namespace, key) if self.shared is not None else None
+        if cached is None:
+            metrics.increment(f"cache.{self.namespace}.miss")
+            return None
+        value, expires_at = cached
+        metrics.increment(f"cache.{self.namespace}.l2_hit")
+        # Keep the L1 copy no longer than the shared entry lives
+        self._store(key, value, min(self.ttl, expires_at - time.time()))
+        return value
+
+    def set(self, key, value):
+        self._store(key, value, self.ttl)
+        if self.shared is not None:
+            self.shared.set(self.namespace, key, value, self.ttl)
+
+    def prime(self, limit):
+        """Load up to limit live entries from the shared tier into the L1"""
+        if self.shared is None:
+            return 0
+        entries = self.shared.recent(self.namespace, limit)
+        for key, value, expires_at in entries:
+            self._store(key, value, min(self.ttl, expires_at - time.time()))
+        return len(entries)
+
+    def _store(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+response_cache = ResponseCache(
+    max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", "256")),
+    ttl=int(os.getenv("RESPONSE_CACHE_TTL", "3600")),
+    shared=shared_cache)
+
+GREETINGS = {"hi", "hey", "hello"}
+
+# Send a cheap placeholder reply on streamed chats before the real answer starts
+SPECULATIVE_REPLIES = os.getenv("SPECULATIVE_REPLIES", "true").lower() == "true"
+# Share of words a first-turn question must have in common with a pack
+# question before that answer's opening is used as the placeholder
+SPECULATIVE_MIN_OVERLAP = float(os.getenv("SPECULATIVE_MIN_OVERLAP", "0.5"))
+
+
+HISTORY_ROLES = {"user", "assistant"}
+
+
+def validate_history(history):
+    """Check history shape and return it reduced to role/content pairs
+
+    Malformed entries and over-long user turns are rejected. Long
+    conversations are not - the oldest turns are trimmed to
+    MAX_HISTORY_MESSAGES / MAX_HISTORY_CHARS and over-long assistant turns
+    are cut to MAX_HISTORY_MESSAGE_CHARS, since the clients always send (and
+    keep) the history we return.
+    """
+    if not isinstance(history, list):
+        raise ChatError('History must be a list', reason="bad_history")
+
+    validated = []
+    for msg in history:
+        if not isinstance(msg, dict):
+            raise ChatError('History messages must be objects', reason="bad_history")
+        role = msg.get('role')
+        content = msg.get('content')
+        if role not in HISTORY_ROLES:
+            raise ChatError('History roles must be "user" or "assistant"', reason="bad_history")
+        if not isinstance(content, str):
+            raise ChatError('History content must be a string', reason="bad_history")
+        if len(content) > MAX_HISTORY_MESSAGE_CHARS:
+            if role == "user":
+                raise ChatError('History message too long', reason="history_too_long")
+            # Assistant turns are our own output - shorten them rather than
+            # failing every later message of the conversation
+            content = content[:MAX_HISTORY_MESSAGE_CHARS]
+            metrics.increment("chat.history_truncated")
+        # Drop any other keys (tool_calls, name, ...) so clients cannot inject them
+        validated.append({"role": role, "content": content})
+
+    trimmed = validated[-MAX_HISTORY_MESSAGES:] if MAX_HISTORY_MESSAGES else []
+    total_chars = sum(len(msg["content"]) for msg in trimmed)
+    while trimmed and (total_chars > MAX_HISTORY_CHARS or trimmed[0]["role"] != "user"):
+        total_chars -= len(trimmed.pop(0)["content"])
+    if len(trimmed) < len(validated):
+        metrics.increment("chat.history_trimmed")
+    return trimmed
+
+
+def validate_stage(ctx):
+    """Parse the request body into a message and an OpenAI-format history"""
+    if not ctx.data:
+        raise ChatError('No JSON data provided', reason="no_data")
+    if not isinstance(ctx.data, dict):
+        raise ChatError('JSON body must be an object', reason="bad_body")
+    ctx.message = ctx.data.get('message', '')
+    if not ctx.message:
+        raise ChatError('No message provided', reason="no_message")
+    if not isinstance(ctx.message, str):
+        raise ChatError('Message must be a string', reason="bad_message")
+    if len(ctx.message) > MAX_MESSAGE_CHARS:
+        raise ChatError(f'Message exceeds {MAX_MESSAGE_CHARS} characters', reason="message_too_long")
+    ctx.speculative = ctx.data.get('speculative', SPECULATIVE_REPLIES)
+    if not isinstance(ctx.speculative, bool):
+        raise ChatError('Speculative must be a boolean', reason="bad_body")
+    # Build a fresh list so the stages below never mutate the request payload
+    ctx.history = validate_history(ctx.data.get('history', []))
+
+
+def persona_stage(ctx):
+    """Resolve the persona, loading it if it is cold"""
+    try:
+        ctx.me = personas.get(ctx.persona_id)
+    except KeyError:
+        raise ChatError('Unknown persona', 404, reason="unknown_persona")
 
 
-@app.route('/api/chat', methods=['POST'])
-def api_chat():
-    """API endpoint for chat - to be used by Framer widget"""
-    try:
-        data = request.get_json()
+def cache_key(ctx):
+    # The documents version keeps answers from before a change to the persona's
+    # files (still in the shared cache, or primed into the L1) from matching
+    return f"{ctx.me.persona_id}:{ctx.me.documents_version[:16]}:{normalize_message(ctx.message)}"
+
+
+def fast_path_stage(ctx):
+    """Answer plain greetings with the canned introduction, no model call"""
+    if not ctx.history and normalize_message(ctx.message) in GREETINGS:
+        ctx.response_text = ctx.me.greeting()
+        ctx.source = "fast_path"
+
 
-        if not data:
-            return jsonify({'error': 'No JSON data provided'}), 400
+def answer_pack_stage(ctx):
+    """Serve first-turn top questions from the precomputed answer pack"""
+    if ctx.response_text is None and not ctx.history:
+        answer = ctx.me.answer_from_pack(ctx.message)
+        if answer is not None:
+            ctx.response_text = answer
+            ctx.source = "answer_pack"
 
-        user_message = data.get('message', '')
-        history = data.get('history', [])
 
-        if not user_message:
-            return jsonify({'error': 'No message provided'}), 400
+def cache_lookup_stage(ctx):
+    """Serve first-turn questions that were answered recently"""
+    if ctx.response_text is None and not ctx.history:
+        cached = response_cache.get(cache_key(ctx))
+        if cached is not None:
+            ctx.response_text = cached
+            ctx.source = "cache"
 
-        # Convert frontend history format to OpenAI format
-        formatted_history = []
-        for msg in history:
-            formatted_history.append(msg)
 
-        # Get response from chatbot
-        response_text = me.chat(user_message, formatted_history)
+def context_stage(ctx):
+    """Build the system prompt and message list for the model"""
+    if ctx.response_text is None:
+        ctx.messages = ctx.me.build_messages(ctx.message, ctx.history)
 
-        # Update history
-        formatted_history.append({"role": "user", "content": user_message})
-        formatted_history.append(
-            {"role": "assistant", "content": response_text})
 
-        return jsonify({
-            'response': response_text,
-            'history': formatted_history,
-            'success': True
-        }), 200
+ACKNOWLEDGEMENTS = {
+    "en": "Good question! Let me think about that for a second...",
+    "sv": "Bra fråga! Låt mig fundera på det en sekund...",
+}
+SWEDISH_WORDS = {"hej", "vad", "jag", "du", "är", "och", "har", "kan", "hur", "vem", "jobbar", "tack"}
+
+
+def looks_swedish(message):
+    return bool(re.search(r"[åäö]", message.lower())) or bool(
+        SWEDISH_WORDS & set(normalize_message(message).split()))
+
+
+def speculative_reply(me, message, first_turn):
+    """Cheap placeholder: the opening of the closest answer-pack answer, else an acknowledgement
+
+    Only first turns use the pack - its answers would not fit a conversation
+    in progress. The response cache is not consulted: the cache stage has
+    just missed on this message.
+    """
+    answer = me.closest_pack_answer(message, SPECULATIVE_MIN_OVERLAP) if first_turn else None
+    if answer:
+        return answer.split("\n\n", 1)[0]
+    return ACKNOWLEDGEMENTS["sv" if looks_swedish(message) else "en"]
+
+
+def model_stage(ctx):
+    """Run the model and tool-call loop (or start streaming it)"""
+    if ctx.response_text is not None:
+        return
+    ctx.source = "model"
+    if not ctx.stream:
+        ctx.response_text = ctx.me.run_model(ctx.messages)
+        return
+    speculative = None
+    if ctx.speculative:
+        me, message, first_turn = ctx.me, ctx.message, not ctx.history
+        speculative = lambda: speculative_reply(me, message, first_turn)
+    ctx.events = ctx.me.stream_events(ctx.messages, speculative=speculative)
+
+
+def post_process_stage(ctx):
+    """Append the new turn to the conversation history"""
+    ctx.history.append({"role": "user", "content": ctx.message})
+    ctx.history.append({"role": "assistant", "content": ctx.response_text})
+
+
+def persist_stage(ctx):
+    """Cache fresh first-turn answers and notify for answers the model skipped"""
+    if ctx.source == "model":
+        if len(ctx.history) == 2:
+            response_cache.set(cache_key(ctx), ctx.response_text)
+    else:
+        # The model normally records every message via its tools
+        record_user_input(ctx.message)
+
+
+class ChatPipeline:
+    """Runs chat stages in order, timing each and skipping disabled ones"""
+
+    REQUIRED_STAGES = {"validate", "persona", "context", "model", "post_process"}
+
+    def __init__(self, stages, disabled=()):
+        self.stages = stages
+        self.disabled = set(disabled) - self.REQUIRED_STAGES
+        for name in set(disabled) & self.REQUIRED_STAGES:
+            print(f"WARNING: chat stage '{name}' is required and cannot be disabled", flush=True)
+
+    def run(self, data, persona_id=None, stream=False):
+        """Run all stages, or with stream=True stop after the model stage
+
+        A streamed ctx carries ctx.events; once they are consumed and
+        ctx.response_text is set, finish() runs the remaining stages.
+        """
+        ctx = ChatContext(data, persona_id)
+        ctx.stream = stream
+        names = [name for name, _ in self.stages]
+        end = names.index("model") + 1 if stream else len(names)
+        self._run_stages(ctx, self.stages[:end])
+        if stream:
+            # The model stage only created the generator; the stream's own
+            # first_token/complete timings measure the model
+            ctx.timings.pop("model", None)
+        return ctx
+
+    def finish(self, ctx):
+        names = [name for name, _ in self.stages]
+        self._run_stages(ctx, self.stages[names.index("model") + 1:])
+        return ctx
+
+    def _run_stages(self, ctx, stages):
+        for name, stage in stages:
+            if name in self.disabled:
+                continue
+            start = time.perf_counter()
+            try:
+                stage(ctx)
+            finally:
+                ctx.timings[name] = (time.perf_counter() - start) * 1000
+
+
+chat_pipeline = ChatPipeline(
+    [
+        ("validate", validate_stage),
+        ("persona", persona_stage),
+        ("fast_path", fast_path_stage),
+        ("answer_pack", answer_pack_stage),
+        ("cache", cache_lookup_stage),
+        ("context", context_stage),
+        ("model", model_stage),
+        ("post_process", post_process_stage),
+        ("persist", persist_stage),
+    ],
+    disabled=[name.strip() for name in os.getenv("CHAT_DISABLED_STAGES", "").split(",") if name.strip()])
+
+
+def server_timing(timings):
+    """Format stage timings as a Server-Timing header value"""
+    return ", ".join(f"{name};dur={ms:.1f}" for name, ms in timings.items())
+
+
+def resolve_persona_id(path_persona_id=None):
+    """Pick the persona from the API key, else the URL path, else the X-Persona header
+
+    A request with an API key can only reach that key's persona; asking for
+    another one by path or header is rejected.
+    """
+    requested = path_persona_id or request.headers.get('X-Persona') or None
+    api_key = request.headers.get('X-API-Key')
+    if not api_key:
+        return requested
+    if api_key not in PERSONA_API_KEYS:
+        raise ChatError('Invalid API key', 401, reason="bad_api_key")
+    pinned = PERSONA_API_KEYS[api_key]
+    if requested and requested != pinned:
+        raise ChatError('API key is not valid for this persona', 403, reason="persona_forbidden")
+    return pinned
+
+
+def read_chat_body():
+    """Parse the JSON body, rejecting oversized ones before reading them"""
+    if request.content_length is not None and request.content_length > MAX_REQUEST_BYTES:
+        raise ChatError('Request body too large', 413, reason="body_too_large")
+    try:
+        return request.get_json(silent=True)
+    except RequestEntityTooLarge:
+        # Chunked bodies without a Content-Length are cut off while reading
+        raise ChatError('Request body too large', 413, reason="body_too_large")
+
 
+def run_chat(api=False, persona_id=None):
+    """Run the pipeline for the current request and build the JSON response"""
+    try:
+        ctx = chat_pipeline.run(read_chat_body(), resolve_persona_id(persona_id))
+    except ChatError as e:
+        metrics.increment(f"chat.rejected.{e.reason}")
+        body, status = {'error': e.message}, e.status
     except Exception as e:
         print(f"Error in chat endpoint: {str(e)}", flush=True)
-        return jsonify({
-            'error': 'An error occurred processing your request',
-            'success': False
-        }), 500
+        metrics.increment("chat.errors")
+        body, status = {'error': 'An error occurred processing your request'}, 500
+    else:
+        metrics.increment(f"chat.source.{ctx.source}")
+        body, status = {'response': ctx.response_text, 'history': ctx.history}, 200
 
+    if api:
+        body['success'] = status == 200
+    response = jsonify(body)
+    if status == 200:
+        response.headers['Server-Timing'] = server_timing(ctx.timings)
+    return response, status
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    try:
-        data = request.get_json()
-        user_message = data.get('message', '')
-        history = data.get('history', [])
 
-        if not user_message:
-            return jsonify({'error': 'No message provided'}), 400
+@app.route('/api/chat', methods=['POST'])
+def api_chat():
+    """API endpoint for chat - to be used by Framer widget"""
+    return run_chat(api=True)
 
-        # Convert frontend history format to OpenAI format
-        formatted_history = []
-        for msg in history:
-            formatted_history.append(msg)
 
-        # Get response from chatbot
-        response_text = me.chat(user_message, formatted_history)
+def sse(event, data):
+    return f"event: {event}\ndata: {app.json.dumps(data)}\n\n"
 
-        # Update history
-        formatted_history.append({"role": "user", "content": user_message})
-        formatted_history.append(
-            {"role": "assistant", "content": response_text})
 
-        return jsonify({
-            'response': response_text,
-            'history': formatted_history
-        })
+def stream_chat(persona_id=None):
+    """Run the pipeline for the current request and stream the answer as SSE
 
+    Events: "speculative" (placeholder text to show until the first token),
+    "token" (answer text delta), "done" (final response, history, timings)
+    and "error". Timings include ttfb (first event of any kind) separately
+    from first_token (first real token) and complete.
+    """
+    start = time.perf_counter()
+    try:
+        ctx = chat_pipeline.run(read_chat_body(), resolve_persona_id(persona_id), stream=True)
+    except ChatError as e:
+        metrics.increment(f"chat.rejected.{e.reason}")
+        return jsonify({'error': e.message, 'success': False}), e.status
     except Exception as e:
-        print(f"Error in chat endpoint: {str(e)}", flush=True)
-        return jsonify({'error': 'An error occurred processing your request'}), 500
+        print(f"Error in chat stream endpoint: {str(e)}", flush=True)
+        metrics.increment("chat.errors")
+        return jsonify({'error': 'An error occurred processing your request', 'success': False}), 500
+
+    def elapsed():
+        return (time.perf_counter() - start) * 1000
+
+    def generate():
+        try:
+            if ctx.events is None:
+                ctx.timings["ttfb"] = ctx.timings["first_token"] = elapsed()
+                yield sse("token", {'text': ctx.response_text})
+            else:
+                parts = []
+                for kind, text in ctx.events:
+                    ctx.timings.setdefault("ttfb", elapsed())
+                    if kind == "speculative":
+                        metrics.increment("chat.speculative.sent")
+                    else:
+                        ctx.timings.setdefault("first_token", elapsed())
+                        parts.append(text)
+                    yield sse(kind, {'text': text})
+                ctx.response_text = "".join(parts)
+            chat_pipeline.finish(ctx)
+            ctx.timings["complete"] = elapsed()
+            for name in ("ttfb", "first_token", "complete"):
+                if name in ctx.timings:
+                    metrics.observe(f"chat.stream.{name}_ms", ctx.timings[name])
+            metrics.increment(f"chat.source.{ctx.source}")
+            yield sse("done", {'response': ctx.response_text, 'history': ctx.history,
+                               'timings': {name: round(ms, 1) for name, ms in ctx.timings.items()},
+                               'success': True})
+        except Exception as e:
+            print(f"Error in chat stream endpoint: {str(e)}", flush=True)
+            metrics.increment("chat.errors")
+            yield sse("error", {'error': 'An error occurred processing your request', 'success': False})
+
+    response = app.response_class(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/api/chat/stream', methods=['POST'])
+def api_chat_stream():
+    """Streaming chat endpoint (Server-Sent Events) with speculative first reply"""
+    return stream_chat()
+
+
+@app.route('/api/personas/<persona_id>/chat', methods=['POST'])
+def api_persona_chat(persona_id):
+    """API chat endpoint pinned to one persona"""
+    return run_chat(api=True, persona_id=persona_id)
+
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    return run_chat()
+
+
+# Worker lifecycle: warm-up, readiness and drain
+class Lifecycle:
+    """Tracks warm-up, in-flight requests and draining for this worker"""
+
+    def __init__(self):
+        self.started = False
+        self.ready = False
+        self.draining = False
+        self.drained = False
+        self.warmup_timings = {}
+        self._in_flight = 0
+        self._idle = threading.Condition()
+
+    def request_started(self):
+        with self._idle:
+            self._in_flight += 1
+
+    def request_finished(self):
+        with self._idle:
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self._idle.notify_all()
+
+    def start(self):
+        """Begin serving: warm up, enable answer pack rebuilds and drain on exit (once per worker)
+
+        Kept out of import time so `flask build-answer-pack` and scripts that
+        import the app do not start background work or drain when they exit.
+        """
+        with self._idle:
+            if self.started:
+                return
+            self.started = True
+        # gunicorn drains through worker_exit first; this covers `python app.py`
+        atexit.register(self.drain)
+        personas.auto_build = ANSWER_PACK_AUTO_BUILD
+        for persona_id in personas.loaded():
+            personas.rebuild_if_stale(personas.get(persona_id))
+        if WARMUP_ON_BOOT:
+            threading.Thread(target=self.warm_up, daemon=True).start()
+        else:
+            self.ready = True
+
+    def warm_up(self):
+        """Pre-build prompts, open pooled connections and prime caches"""
+        steps = [("prompt", warm_up_prompt)]
+        if WARMUP_CONNECTIONS:
+            steps.append(("connections", warm_up_connections))
+        if WARMUP_PRIME_CACHE:
+            steps.append(("cache", warm_up_cache))
+        for name, step in steps:
+            start = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                print(f"Warm-up step '{name}' failed: {str(e)}", flush=True)
+            self.warmup_timings[name] = round((time.perf_counter() - start) * 1000, 1)
+        self.ready = True
+        print(f"Worker {os.getpid()} ready, warm-up took {self.warmup_timings}", flush=True)
+
+    def begin_drain(self):
+        """Stop reporting ready; safe to call from a signal handler"""
+        self.draining = True
+
+    def drain(self, timeout=None, flush_timeout=None):
+        """Stop reporting ready, let in-flight requests finish, then flush notifications"""
+        with self._idle:
+            if self.drained:
+                return
+            self.drained = True
+        self.begin_drain()
+        timeout = DRAIN_TIMEOUT if timeout is None else timeout
+        flush_timeout = DRAIN_FLUSH_TIMEOUT if flush_timeout is None else flush_timeout
+        with self._idle:
+            self._idle.wait_for(lambda: self._in_flight == 0, timeout=timeout)
+            unfinished = self._in_flight
+        flushed = notifications.flush(flush_timeout)
+        print(f"Worker {os.getpid()} drained ({unfinished} requests still running, "
+              f"notifications {'flushed' if flushed else 'NOT flushed'})", flush=True)
+
+
+def warm_up_prompt():
+    personas.get().prebuilt_system_prompt()
+
+
+def warm_up_connections():
+    # Establish the TLS connections now rather than on the first chat
+    personas.get().openai.models.list()
+    if os.getenv("PUSHOVER_TOKEN"):
+        notifications.session.head("https://api.pushover.net/", timeout=10)
+
+
+def warm_up_cache():
+    primed = response_cache.prime(WARMUP_PRIME_CACHE)
+    metrics.increment("cache.response.primed", primed)
+
+
+WARMUP_ON_BOOT = os.getenv("WARMUP_ON_BOOT", "true").lower() == "true"
+WARMUP_CONNECTIONS = os.getenv("WARMUP_CONNECTIONS", "true").lower() == "true"
+# Number of shared response cache entries to load into the L1 (0 disables)
+WARMUP_PRIME_CACHE = int(os.getenv("WARMUP_PRIME_CACHE", "200"))
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "30"))
+# Budget for sending queued notifications once requests have finished
+DRAIN_FLUSH_TIMEOUT = float(os.getenv("DRAIN_FLUSH_TIMEOUT", "5"))
+
+lifecycle = Lifecycle()
+
+
+@app.before_request
+def track_request_start():
+    # gunicorn starts workers from post_worker_init; this covers other servers
+    lifecycle.start()
+    lifecycle.request_started()
+
+
+@app.teardown_request
+def track_request_end(exc):
+    lifecycle.request_finished()
+
+
+@app.route('/api/ready', methods=['GET'])
+def readiness_check():
+    """Readiness: 200 once warmed up, 503 while warming up or draining"""
+    if lifecycle.draining:
+        return jsonify({'status': 'draining'}), 503
+    if not lifecycle.ready:
+        return jsonify({'status': 'warming_up'}), 503
+    return jsonify({'status': 'ready', 'warmup_ms': lifecycle.warmup_timings}), 200
+
 
 
 if __name__ == "__main__":
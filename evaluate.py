@@ -0,0 +1,253 @@
+"""Offline answer-quality regression suite for the chatbot.
+
+Runs a fixed question set (eval/questions.json) through the real /api/chat
+pipeline with chat.completions.create replaced by a recording/replay stub,
+so caching, routing and context changes can be judged on cost and quality
+without calling OpenAI.
+
+    python evaluate.py                 # replay eval/cassette.json, stub the rest
+    python evaluate.py --record        # call OpenAI once and (re)write the cassette
+    python evaluate.py --json report.json --min-pass-rate 0.9
+
+Each question is checked for:
+- context: every fact in "context_facts" is present in what was sent to the model
+- answer: every fact in "answer_facts" is in the answer (skipped when the answer
+  came from the deterministic stub rather than a recorded model response)
+"""
+import argparse
+import hashlib
+import json
+import os
+import statistics
+import sys
+import time
+
+from openai.types.chat import ChatCompletion
+
+# Replay needs no real key - the stub never reaches the network
+os.environ.setdefault("OPENAI_API_KEY", "sk-offline-eval")
+# Pack rebuilds would call the model behind the stub's back
+os.environ["ANSWER_PACK_AUTO_BUILD"] = "false"
+# Keep runs hermetic - no answers shared with (or left for) a running server
+os.environ["SHARED_CACHE_PATH"] = ""
+os.environ["WARMUP_ON_BOOT"] = "false"
+
+import app as chatbot  # noqa: E402
+
+
+def to_jsonable(message):
+    """OpenAI message objects appended by the tool loop -> plain dicts"""
+    if hasattr(message, "model_dump"):
+        return message.model_dump(exclude_none=True)
+    return message
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) when no usage was recorded"""
+    return max(1, len(text) // 4)
+
+
+class StubCompletions:
+    """Stands in for client.chat.completions, recording or replaying responses
+
+    Responses are keyed by question id and call number, so a recorded answer
+    still replays after the context changes; the request hash is kept so the
+    report can flag calls whose context differs from the recording.
+    """
+
+    def __init__(self, cassette, record=False, real=None):
+        self.cassette = cassette
+        self.record = record
+        self.real = real
+        self.question_id = None
+        self.calls = []
+
+    def start(self, question_id):
+        self.question_id = question_id
+        self.calls = []
+
+    def create(self, model, messages, tools=None, **kwargs):
+        messages = [to_jsonable(m) for m in messages]
+        request_hash = hashlib.sha256(
+            json.dumps([model, messages], sort_keys=True).encode("utf-8")).hexdigest()
+        key = f"{self.question_id}:{len(self.calls)}"
+        call = {"messages": messages, "request_hash": request_hash}
+
+        if self.record:
+            start = time.perf_counter()
+            response = self.real.chat.completions.create(
+                model=model, messages=messages, tools=tools, **kwargs)
+            self.cassette[key] = {
+                "request_hash": request_hash,
+                "response": response.model_dump(),
+                "model_ms": (time.perf_counter() - start) * 1000,
+            }
+        if key in self.cassette:
+            entry = self.cassette[key]
+            call.update(source="recorded", model_ms=entry["model_ms"],
+                        context_changed=entry["request_hash"] != request_hash)
+            response = ChatCompletion.model_validate(entry["response"])
+        else:
+            call.update(source="stub", model_ms=0.0, context_changed=False)
+            response = self.stub_response(messages)
+
+        if response.usage is not None:
+            call["prompt_tokens"] = response.usage.prompt_tokens
+            call["completion_tokens"] = response.usage.completion_tokens
+        else:
+            call["prompt_tokens"] = estimate_tokens(json.dumps(messages))
+            call["completion_tokens"] = estimate_tokens(
+                response.choices[0].message.content or "")
+        self.calls.append(call)
+        return response
+
+    def stub_response(self, messages):
+        """Deterministic model: record the input via tools first, then answer"""
+        last = messages[-1]
+        if last["role"] == "user":
+            arguments = json.dumps({"user_message": last["content"]})
+            message = {"role": "assistant", "content": None, "tool_calls": [{
+                "id": f"call_{len(self.calls)}", "type": "function",
+                "function": {"name": "record_user_input", "arguments": arguments}}]}
+            finish_reason = "tool_calls"
+        else:
+            question = next(m["content"] for m in reversed(messages) if m["role"] == "user")
+            message = {"role": "assistant", "content": f"[stub answer to: {question}]"}
+            finish_reason = "stop"
+        return ChatCompletion.model_validate({
+            "id": "stub", "object": "chat.completion", "created": 0, "model": "stub",
+            "choices": [{"index": 0, "finish_reason": finish_reason, "message": message}],
+        })
+
+
+def contains_all(text, facts):
+    lowered = text.lower()
+    return [fact for fact in facts if fact.lower() not in lowered]
+
+
+def evaluate_question(client, stub, question):
+    """Ask one question through /api/chat and check context and answer"""
+    stub.start(question["id"])
+    # Every question starts cold so cached answers never mask a context regression
+    chatbot.response_cache = chatbot.ResponseCache(
+        max_entries=chatbot.response_cache.max_entries, ttl=chatbot.response_cache.ttl)
+
+    start = time.perf_counter()
+    response = client.post("/api/chat", json={
+        "message": question["question"], "history": question.get("history", [])})
+    latency_ms = (time.perf_counter() - start) * 1000
+    body = response.get_json()
+    answer = body.get("response") or ""
+
+    result = {
+        "id": question["id"],
+        "status": response.status_code,
+        "model_calls": len(stub.calls),
+        "prompt_tokens": sum(c["prompt_tokens"] for c in stub.calls),
+        "completion_tokens": sum(c["completion_tokens"] for c in stub.calls),
+        "latency_ms": latency_ms,
+        "model_ms": sum(c["model_ms"] for c in stub.calls),
+        "context_changed": any(c["context_changed"] for c in stub.calls),
+    }
+
+    # The context is what the first model call saw; no call means it was answered
+    # without the model (fast path / cache) and there is no context to check
+    context_facts = question.get("context_facts", [])
+    if stub.calls and context_facts:
+        context = "\n".join(
+            m.get("content") or "" for m in stub.calls[0]["messages"])
+        result["missing_context"] = contains_all(context, context_facts)
+    else:
+        result["missing_context"] = []
+
+    answer_facts = question.get("answer_facts", [])
+    answered_by_stub = any(c["source"] == "stub" for c in stub.calls)
+    result["answer_checked"] = bool(answer_facts) and not answered_by_stub
+    result["missing_answer"] = contains_all(answer, answer_facts) if result["answer_checked"] else []
+
+    result["passed"] = (response.status_code == 200
+                        and not result["missing_context"]
+                        and not result["missing_answer"])
+    return result
+
+
+def print_report(results):
+    print(f"{'question':<24} {'ok':<4} {'calls':>5} {'prompt':>7} {'compl':>6} {'ms':>7}  notes")
+    for r in results:
+        notes = []
+        if r["missing_context"]:
+            notes.append(f"context missing {r['missing_context']}")
+        if r["missing_answer"]:
+            notes.append(f"answer missing {r['missing_answer']}")
+        if not r["answer_checked"]:
+            notes.append("answer not checked")
+        if r["context_changed"]:
+            notes.append("context changed since recording")
+        print(f"{r['id']:<24} {'yes' if r['passed'] else 'NO':<4} {r['model_calls']:>5} "
+              f"{r['prompt_tokens']:>7} {r['completion_tokens']:>6} {r['latency_ms']:>7.1f}  "
+              f"{'; '.join(notes)}")
+
+
+def summarize(results):
+    latencies = [r["latency_ms"] for r in results]
+    return {
+        "questions": len(results),
+        "pass_rate": sum(r["passed"] for r in results) / len(results),
+        "prompt_tokens": sum(r["prompt_tokens"] for r in results),
+        "completion_tokens": sum(r["completion_tokens"] for r in results),
+        "model_calls": sum(r["model_calls"] for r in results),
+        "latency_ms_median": statistics.median(latencies),
+        "latency_ms_max": max(latencies),
+        "recorded_model_ms": sum(r["model_ms"] for r in results),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline answer-quality regression suite")
+    parser.add_argument("--questions", default="eval/questions.json")
+    parser.add_argument("--cassette", default="eval/cassette.json")
+    parser.add_argument("--record", action="store_true",
+                        help="call the real model and write its responses to the cassette")
+    parser.add_argument("--json", help="also write the full report to this file")
+    parser.add_argument("--min-pass-rate", type=float, default=1.0)
+    args = parser.parse_args(argv)
+
+    with open(args.questions, "r", encoding="utf-8") as f:
+        questions = json.load(f)
+    cassette = {}
+    if os.path.exists(args.cassette) and not args.record:
+        with open(args.cassette, "r", encoding="utf-8") as f:
+            cassette = json.load(f)
+
+    me = chatbot.personas.get()
+    stub = StubCompletions(cassette, record=args.record, real=me.openai)
+    me.openai = type("StubClient", (), {"chat": type("StubChat", (), {"completions": stub})})()
+    # Never send Pushover notifications from an evaluation run
+    chatbot.push = lambda text: None
+    # Precomputed answers would skip the model and with it the context checks
+    chatbot.chat_pipeline.disabled.add("answer_pack")
+    # Not a serving worker: no warm-up, background rebuilds or drain on exit
+    chatbot.lifecycle.started = chatbot.lifecycle.ready = True
+
+    client = chatbot.app.test_client()
+    results = [evaluate_question(client, stub, q) for q in questions]
+
+    if args.record:
+        with open(args.cassette, "w", encoding="utf-8") as f:
+            json.dump(cassette, f, indent=2, ensure_ascii=False)
+
+    print_report(results)
+    summary = summarize(results)
+    print(f"\npass rate {summary['pass_rate']:.0%} ({summary['questions']} questions), "
+          f"{summary['model_calls']} model calls, "
+          f"{summary['prompt_tokens']} prompt + {summary['completion_tokens']} completion tokens, "
+          f"median latency {summary['latency_ms_median']:.1f} ms")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "results": results}, f, indent=2, ensure_ascii=False)
+    return 0 if summary["pass_rate"] >= args.min_pass_rate else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -28,6 +28,9 @@ interface ChatWidgetProps {
 // API SERVICE
 // ============================================================================
 
+// Matches the backend's MAX_HISTORY_MESSAGES
+const MAX_HISTORY_MESSAGES = 50;
+
 class ChatAPI {
   private baseUrl: string;
 
@@ -309,7 +312,7 @@ const ChatWidget: ComponentType<ChatWidgetProps> = ({
     setError(null);
 
     try {
-      const historyForAPI = messages.filter(msg => msg.content !== initialMessage);
+      const historyForAPI = messages.filter(msg => msg.content !== initialMessage).slice(-MAX_HISTORY_MESSAGES);
       const response = await api.sendMessage(message, historyForAPI);
       setMessages(prev => [...prev, { role: "assistant", content: response.response }]);
     } catch (err) {
@@ -0,0 +1,39 @@
+# Gunicorn settings - loaded automatically from the working directory
+import os
+import signal
+
+bind = f"0.0.0.0:{os.getenv('PORT', '7860')}"
+workers = 2
+threads = 4
+timeout = 120
+# Time a worker gets on SIGTERM to finish in-flight chats before it is killed
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))
+accesslog = "-"
+errorlog = "-"
+
+
+def post_worker_init(worker):
+    """Warm the worker up as soon as it boots, and report draining from SIGTERM on"""
+    from app import lifecycle
+    lifecycle.start()
+
+    # worker_exit only runs once the worker has stopped serving, too late for
+    # /api/ready to say so - flag draining as soon as the signal arrives
+    handle_exit = signal.getsignal(signal.SIGTERM)
+
+    def begin_drain(signum, frame):
+        lifecycle.begin_drain()
+        if callable(handle_exit):
+            handle_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, begin_drain)
+
+
+def worker_exit(server, worker):
+    """Gunicorn has already finished in-flight requests - just flush notifications
+
+    graceful_timeout has largely been spent by now, so the flush gets its own
+    short budget (DRAIN_FLUSH_TIMEOUT) instead of another full timeout.
+    """
+    from app import lifecycle
+    lifecycle.drain(timeout=0)